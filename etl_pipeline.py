@@ -1,18 +1,108 @@
 # etl_pipeline.py
 from __future__ import annotations
 
+import json
+import logging
+import time
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Callable, List, Tuple
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 
-@dataclass
+
+logger = logging.getLogger(__name__)
+
+
+# Forskjellen mellom veggklokke og monotonic-klokke, målt én gang ved import.
+# Brukes bare for å gjøre monotonic_ns-tider om til ISO-tidsstempler når rapporten skrives ut.
+_WALL_CLOCK_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+
+def _monotonic_ns_to_iso(monotonic_ns: int) -> str:
+    return datetime.fromtimestamp((monotonic_ns + _WALL_CLOCK_OFFSET_NS) / 1e9, tz=timezone.utc).isoformat()
+
+
+@dataclass(slots=True, frozen=True)
 class StepResult:
     name: str
     ok: bool
     message: str
-    started_at: str
-    finished_at: str
+    started_ns: int  # time.monotonic_ns() når steget startet
+    finished_ns: int  # time.monotonic_ns() når steget var ferdig
+
+    # Formateres først når noen ber om dem (f.eks. i rapporten), ikke mens pipeline kjører.
+    # Vanlig property i stedet for cached_property, siden slots=True ikke gir objektet en __dict__ å cache i.
+    @property
+    def started_at_iso(self) -> str:
+        return _monotonic_ns_to_iso(self.started_ns)
+
+    @property
+    def finished_at_iso(self) -> str:
+        return _monotonic_ns_to_iso(self.finished_ns)
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.finished_ns - self.started_ns) / 1e6
+
+
+@dataclass(slots=True, frozen=True)
+class PipelineStep:
+    name: str
+    fn: Callable[[], str]
+    depends_on: Tuple[str, ...] = ()
+    retries: int = 0  # Antall nye forsøk etter første feil (bare for feil i retry_on)
+    backoff: float = 2.0  # Ventetid før første nye forsøk (sekunder), dobles for hvert forsøk
+    retry_on: Tuple[type, ...] = (ConnectionError,)  # Feiltyper som regnes som forbigående
+
+
+class Report:
+    """
+    Pipeline-rapporten lagret kolonnevis (én liste/array per felt i stedet for ett objekt per steg).
+    Start/slutt-tider ligger som int64, så varighet for alle steg kan regnes ut på én gang (durations_ns).
+    Iterering gir StepResult-objekter, så rapporten kan brukes som en vanlig liste med resultater.
+    """
+
+    __slots__ = ("names", "oks", "messages", "_starts", "_ends")
+
+    def __init__(self) -> None:
+        self.names: List[str] = []
+        self.oks: List[bool] = []
+        self.messages: List[str] = []
+        self._starts = array("q")
+        self._ends = array("q")
+
+    def append(self, result: StepResult) -> None:
+        self.names.append(result.name)
+        self.oks.append(result.ok)
+        self.messages.append(result.message)
+        self._starts.append(result.started_ns)
+        self._ends.append(result.finished_ns)
+
+    @property
+    def starts(self) -> np.ndarray:
+        return np.array(self._starts, dtype=np.int64)
+
+    @property
+    def ends(self) -> np.ndarray:
+        return np.array(self._ends, dtype=np.int64)
+
+    @property
+    def durations_ns(self) -> np.ndarray:
+        return self.ends - self.starts
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, i: int) -> StepResult:
+        return StepResult(name=self.names[i], ok=self.oks[i], message=self.messages[i],
+                          started_ns=self._starts[i], finished_ns=self._ends[i])
+
+    def __iter__(self) -> Iterator[StepResult]:
+        for i in range(len(self.names)):
+            yield self[i]
 
 
 """
@@ -20,57 +110,169 @@ ETLPipeline er en enkel "orchestrator" for ETL-jobber.
 
 Hva den skal gjøre:
 - Gi deg en strukturert måte å kjøre en ETL som en rekke tydelige steg (steps).
+- Kjøre steg som ikke avhenger av hverandre parallelt. Hvert steg kan si hvilke steg det avhenger av
+  (depends_on), og starter først når de er ferdige. Total kjøretid blir dermed den lengste kjeden av steg,
+  ikke summen av alle.
 - Gjøre main.py ryddig ved å flytte kontrollflyt (hvilke steg som kjøres, i hvilken rekkefølge) inn i en klasse.
-- Returnere en rapport (liste av StepResult) som kan printes eller logges, slik at jobben ser "prod-ready" ut.
+- Returnere en rapport (Report, som kan itereres som StepResult-er) som kan printes eller logges, slik at jobben ser "prod-ready" ut.
 
 Designvalg:
 - Hvert steg er en funksjon som returnerer en kort status-melding (string).
-- Hvis et steg feiler, stopper pipeline (fail-fast). Dette er ofte ønskelig i data-pipelines
+- Hvis et steg feiler, stopper pipeline (fail-fast): ingen nye steg startes, steg som allerede kjører
+  får gjøre seg ferdige, og feilen kastes videre. Dette er ofte ønskelig i data-pipelines
   for å unngå at man eksporterer/transformerer på dårlig grunnlag.
-- Tidsstempler (start/slutt) lagres per steg, så du kan dokumentere runtime og feilsøke enkelt.
+- Steg som kjører parallelt må ikke dele Snowflake-connection; gi hver parallelle gren sin egen SnowflakeClient.
+- Tidsstempler (start/slutt, time.monotonic_ns) lagres per steg, så du kan dokumentere runtime og feilsøke enkelt.
+- Hvert ferdige steg logges som én JSON-linje via logging (logger "etl_pipeline"), ikke print.
+- Et steg kan få nye forsøk (retries, med økende ventetid) ved forbigående feil (retry_on). Et nytt forsøk
+  starter først når det forrige har returnert eller feilet, så to forsøk kjører aldri samtidig.
+- Pipeline har ingen egen timeout, siden en tråd ikke kan avbrytes fra Python. Tidsgrenser settes i Snowflake
+  i stedet (timeout= på queries, timeout= i wait_for_copy), der queryen faktisk blir stoppet.
 
 Typisk bruk:
 pipeline = ETLPipeline("daily_customer_export")
 pipeline.add_step("connect", ...)
-pipeline.add_step("validate_sources", ...)
-pipeline.add_step("transform_marts", ...)
-pipeline.add_step("export", ...)
+pipeline.add_step("validate_sources", ..., depends_on=["connect"])
+pipeline.add_step("transform_marts", ..., depends_on=["validate_sources"])
+pipeline.add_step("export", ..., depends_on=["transform_marts"])
 results = pipeline.run_pipeline()
 """
 
 
 class ETLPipeline:
-    def __init__(self, name: str):
+    def __init__(self, name: str, max_workers: Optional[int] = None):
         self.name = name
-        self.pipeline_steps: List[Tuple[str, Callable[[], str]]] = []  # Liste med pipeline-steg: (navn på steg, funksjon som kjøres og returnerer status-tekst)
+        self.max_workers = max_workers  # Maks antall steg som kjører samtidig (None = ThreadPoolExecutor sin default)
+        self.pipeline_steps: List[PipelineStep] = []  # Liste med pipeline-steg i den rekkefølgen de ble lagt til
+
+
+
+    def add_step(
+            self,
+            name: str,
+            fn: Callable[[], str],
+            depends_on: Optional[List[str]] = None,
+            retries: int = 0,
+            backoff: float = 2.0,
+            retry_on: Tuple[type, ...] = (ConnectionError,),
+    ) -> None:
+        if any(step.name == name for step in self.pipeline_steps):
+            raise ValueError(f"Step '{name}' is already added to pipeline '{self.name}'")
+        self.pipeline_steps.append(PipelineStep(name=name, fn=fn, depends_on=tuple(depends_on or ()),
+                                                retries=retries, backoff=backoff,
+                                                retry_on=tuple(retry_on)))
+
+
+
+    def _log_step(self, result: StepResult) -> None:
+        # Én JSON-linje per steg, så loggen er lett å søke i og parse
+        record = {
+            "pipeline": self.name,
+            "step": result.name,
+            "ok": result.ok,
+            "duration_ms": round(result.duration_ms, 3),
+            "message": result.message,
+        }
+        logger.log(logging.INFO if result.ok else logging.ERROR, json.dumps(record, separators=(",", ":"), default=str))
+
+
+
+    def _run_step(self, step: PipelineStep) -> Tuple[StepResult, Optional[Exception]]:
+        started_ns = time.monotonic_ns()
+
+        try:
+            attempt = 0
+            while True:
+                try:
+                    message = step.fn()
+                    break
+                except step.retry_on as e:
+                    if attempt >= step.retries:
+                        raise
+                    delay = step.backoff * 2 ** attempt
+                    attempt += 1
+                    logger.warning("Step '%s' failed (%s), retry %d/%d in %.1f s", step.name, e, attempt, step.retries, delay)
+                    time.sleep(delay)
+
+            finished_ns = time.monotonic_ns()
+
+            result = StepResult(name=step.name, ok=True, message=message, started_ns=started_ns, finished_ns=finished_ns)
+            self._log_step(result)
+            return result, None
+
+        except Exception as e:
+            finished_ns = time.monotonic_ns()
+
+            # Logg feilen inn i pipeline-reporten
+            result = StepResult(name=step.name, ok=False, message=str(e), started_ns=started_ns, finished_ns=finished_ns,)
+            self._log_step(result)
+            return result, e
+
+
+
+    def _check_for_cycles(self, waiting_on: Dict[str, set]) -> None:
+        # Topologisk sortering (Kahn): fjerner steg uten gjenstående avhengigheter til ingen er igjen.
+        # Steg som aldri blir frie ligger i en sykel (eller avhenger av en).
+        remaining = {name: set(depends_on) for name, depends_on in waiting_on.items()}
+        ready = [name for name, depends_on in remaining.items() if not depends_on]
+
+        while ready:
+            name = ready.pop()
+            del remaining[name]
+            for other, depends_on in remaining.items():
+                if name in depends_on:
+                    depends_on.discard(name)
+                    if not depends_on:
+                        ready.append(other)
 
+        if remaining:
+            raise ValueError(f"Pipeline '{self.name}' has a dependency cycle between: {sorted(remaining)}")
 
 
-    def add_steps_to_pipeline(self, name: str, fn: Callable[[], str]) -> None:
-        self.pipeline_steps.append((name, fn))
 
+    def run_pipeline(self) -> Report:  # Returnerer en Report med ett resultat per pipeline-steg, i samme rekkefølge som de ble lagt til
+        steps: Dict[str, PipelineStep] = {step.name: step for step in self.pipeline_steps}
+        waiting_on: Dict[str, set] = {step.name: set(step.depends_on) for step in self.pipeline_steps}
 
-    def run_pipeline(self) -> List[StepResult]:  # Returnerer en liste med StepResult (én per pipeline-steg)
-        results: List[StepResult] = []
+        for name, depends_on in waiting_on.items():
+            unknown = depends_on - steps.keys()
+            if unknown:
+                raise ValueError(f"Step '{name}' depends on unknown step(s): {sorted(unknown)}")
 
-        for name, fn in self.pipeline_steps:
-            started_at = datetime.utcnow().isoformat()
+        self._check_for_cycles(waiting_on)  # Stopper før noe steg er startet, ikke etter at resten har kjørt
 
-            try:
-                message = fn()
-                finished_at = datetime.utcnow().isoformat()
+        results: Dict[str, StepResult] = {}
+        finished: set = set()
+        failure: Optional[Exception] = None
 
-                results.append(StepResult(name=name, ok=True, message=message, started_at=started_at, finished_at=finished_at))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
 
-            except Exception as e:
-                finished_at = datetime.utcnow().isoformat()
+            while True:
+                if failure is None:
+                    ready = [name for name, depends_on in waiting_on.items() if depends_on <= finished]
+                    for name in ready:
+                        del waiting_on[name]
+                        running[executor.submit(self._run_step, steps[name])] = name
 
-                # Logg feilen inn i pipeline-reporten
-                results.append(StepResult(name=name, ok=False, message=str(e), started_at=started_at, finished_at=finished_at,))
+                if not running:
+                    break
 
-                print("hva sier erroren?", e)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    result, error = future.result()
+                    results[name] = result
 
-                raise
+                    if error is None:
+                        finished.add(name)
+                    elif failure is None:
+                        failure = error
 
+        if failure is not None:
+            raise failure
 
-        return results
+        report = Report()
+        for step in self.pipeline_steps:
+            report.append(results[step.name])
+        return report
@@ -1,15 +1,22 @@
 from __future__ import annotations  # Lar oss bruke type hints som "SnowflakeJobRunner" uten å bekymre oss for rekkefølge på imports
 
+import logging  # Logging fra klient og pipeline (i stedet for print)
+import sys  # sys.stdout.write for rapporten
+import queue  # Kø mellom trådene som logger og tråden som skriver loggen
+from logging.handlers import QueueHandler, QueueListener  # Logging via kø, så worker-tråder aldri skriver til stdout selv
 from pathlib import Path  # Brukes for å lage mapper (exports/) på en robust måte
 
-from snowflake_config import SnowflakeConfig  # Leser Snowflake-config (user, password, account candidates osv.)
-from snowflake_client import SnowflakeClient  # Client som kobler til Snowflake og holder connection
+from snowflake_config import get_config  # Leser Snowflake-config (user, password, account candidates osv.)
+from snowflake_client import SnowflakeClient, TRANSIENT_ERRORS  # Client som kobler til Snowflake og holder connection, og feiltyper som er verdt å prøve på nytt
 from snowflake_jobs import SnowflakeJobRunner  # "Job layer" som gir execute/copy-into/get/rowcount osv.
 from etl_pipeline import ETLPipeline  # Enkel pipeline-orchestrator med steg (steps) og rapport
 
 
 
 
+logger = logging.getLogger(__name__)
+
+
 # Fullt kvalifisert tabellnavn til mart-tabellen din i Snowflake
 MART_TABLE = "VLO_SNOWFLAKE_LAB.ANALYTICS.MART_CUSTOMER_KPIS"
 
@@ -19,11 +26,35 @@ EXPORT_STAGE = "VLO_EXPORT_STAGE"
 # Lokal mappe der eksportfiler lastes ned
 EXPORT_DIR = "exports"
 
+# Antall nye forsøk for et steg ved forbigående Snowflake-feil (nettverk, 503/504)
+STEP_RETRIES = 2
+
+# Maks sekunder vi venter på at eksporten (COPY INTO) blir ferdig før den avbrytes i Snowflake
+COPY_TIMEOUT_S = 1800
+
+
+
+def setup_logging(level: int = logging.INFO) -> QueueListener:
+    # Alle loggere sender records til en kø (billig, ingen låsing på stdout i pipeline-trådene).
+    # Én bakgrunnstråd (QueueListener) formaterer og skriver dem. Husk å kalle .stop() til slutt, så køen tømmes.
+    log_queue: queue.Queue = queue.Queue()
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(QueueHandler(log_queue))
+
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
 
 
 def main() -> None:
-    # Lager config-objektet (typisk fra env/.env eller defaults)
-    config = SnowflakeConfig()
+    # Henter config-objektet (typisk fra env/.env eller defaults). Samme immutable instans hver gang.
+    config = get_config()
 
     # Oppretter en pipeline med et navn (brukes mest for lesbarhet / logging / rapport)
     pipeline = ETLPipeline(name="customer_kpis_export_top10")
@@ -34,22 +65,48 @@ def main() -> None:
     # Kobler til Snowflake (prøver flere account candidates om du har det satt opp sånn)
     client.connect_to_snowflake()
 
-    # Lager job-runneren som bruker eksisterende connection for å gjøre Snowflake-operasjoner
+    # Egen connection til stegene som kjører parallelt med eksporten. Den hentes fra poolen hvis
+    # en ledig connection finnes (SNOWFLAKE_POOL_MIN > 0), ellers er dette en ny login.
+    # Snowflake-sessions skal ikke deles mellom tråder, så hver parallell gren får sin egen klient.
+    validation_client = SnowflakeClient(config)
+    validation_client.connect_to_snowflake()
+
+    # Lager job-runnere som bruker eksisterende connections for å gjøre Snowflake-operasjoner
     jobs = SnowflakeJobRunner(client)
+    validation_jobs = SnowflakeJobRunner(validation_client)
 
     # ---- STEG 1: Session info ----
     # Vi legger til et steg i pipeline. Det er en funksjon (lambda) som returnerer en status-string.
     # session_info() kjører en liten SELECT for å hente konto, region, user, role.
-    pipeline.add_steps_to_pipeline("session_info", lambda: f"Session: {client.show_session_info()}")
+    pipeline.add_step(
+        "session_info",
+        lambda: f"Session: {validation_client.show_session_info(timeout=30)}",  # Liten SELECT, skal være ferdig på sekunder
+        retries=STEP_RETRIES,
+        retry_on=TRANSIENT_ERRORS,
+    )
 
     # ---- STEG 2: Validering ----
-    # Teller antall rader i mart-tabellen. Dette fungerer som enkel datakvalitetssjekk før export.
-    pipeline.add_steps_to_pipeline(
+    # Enkle datakvalitetssjekker på mart-tabellen før export: antall rader, manglende lifetime_value og nyeste ordre.
+    # Nedlastingen (steg 4) venter på at dette steget er godkjent.
+    # Alle sjekkene kjøres i én SELECT, så tabellen scannes bare én gang.
+    # Bruker samme connection som session_info, så den venter på den (depends_on).
+    pipeline.add_step(
         "validate_mart_has_rows",
-        lambda: f"{MART_TABLE} rows={jobs.count_rows(MART_TABLE)}",
+        lambda: f"{MART_TABLE} checks=" + str(validation_jobs.validate(MART_TABLE, {
+            "rowcount": "COUNT(*)",
+            "null_lifetime_value": "COUNT_IF(lifetime_value IS NULL)",
+            "max_last_order_date": "MAX(last_order_date)",
+        }, timeout=300)),                    # Scanner hele mart-tabellen; Snowflake avbryter queryen etter 300 s
+        depends_on=["session_info"],
+        retries=STEP_RETRIES,
+        retry_on=TRANSIENT_ERRORS,
     )
 
     # ---- STEG 3: COPY INTO stage ----
+    # COPY INTO startes asynkront: steget returnerer så fort Snowflake har tatt imot queryen,
+    # og eksporten kjører på serveren mens valideringsstegene kjører. Jobben lagres her til GET-steget.
+    copy_jobs = {}
+
     # Vi lager en egen funksjon fordi steget er flere linjer og har litt logikk.
     def copy_into_stage() -> str:
         # Query-en vi vil eksportere. Her tar vi top 10 customers.
@@ -62,29 +119,36 @@ def main() -> None:
 
         # COPY INTO @stage/prefix/ FROM ( <query> )
         # Dette er en Snowflake-native eksport, og ser veldig "data engineering" ut.
-        stage_path = jobs.copy_query_results_to_stage_csv(
+        copy_jobs["top10"] = jobs.copy_query_to_stage_async(
             sql_query=query,                 # SQL-query som skal eksporteres
             stage_name=EXPORT_STAGE,         # Snowflake stage som filene skrives til
             stage_prefix="customer_kpis/top10",  # "folder path" inne i stage
             overwrite=True,                  # Overskriv tidligere eksport med samme path
-            single=True,                     # Forsøk å få én fil (praktisk for demo)
+            # single=False (default): Snowflake navngir filene selv (data_0_0_0.snappy.parquet osv.),
+            # så GET aldri overskriver en eldre fil med samme navn men et annet format
+            file_format="PARQUET",           # Snappy-komprimert Parquet (mindre og raskere enn CSV)
         )
 
         # Returnerer en kort status-melding som blir lagret i pipeline rapporten
-        return f"Copied to stage: {stage_path}"
+        return f"Started COPY INTO {copy_jobs['top10'].stage_path} (query id {copy_jobs['top10'].query_id})"
 
-    # Legger COPY INTO-steget inn i pipeline
-    pipeline.add_steps_to_pipeline("copy_into_stage", copy_into_stage)
+    # Legger COPY INTO-steget inn i pipeline (avhenger ikke av noe, så det starter med en gang).
+    # Ingen retries: hvis innsendingen feiler etter at Snowflake har startet queryen, ville et nytt forsøk
+    # startet en ny COPY INTO mot samme prefix mens den første fortsatt kjører.
+    pipeline.add_step("copy_into_stage", copy_into_stage)
 
     # ---- STEG 4: GET fra stage til lokal mappe ----
     def download_from_stage() -> str:
         # Lager exports/-mappen lokalt hvis den ikke finnes
         Path(EXPORT_DIR).mkdir(parents=True, exist_ok=True)
 
+        # Venter til COPY INTO er ferdig på serveren (kaster feil hvis den feilet)
+        stage_path = jobs.wait_for_copy(copy_jobs["top10"], timeout=COPY_TIMEOUT_S)
+
         # GET @stage/path file://<local_path>/
         # Dette laster ned filene som COPY INTO la på stage.
         res = jobs.download_stage_to_local(
-            f"@{EXPORT_STAGE}/customer_kpis/top10/",
+            stage_path,
             EXPORT_DIR,
         )
 
@@ -92,24 +156,50 @@ def main() -> None:
         # Returnerer statusmelding for rapport
         return f"Downloaded {res.files_downloaded} file(s) to: {res.local_dir}"
 
-    # Legger download-steget inn i pipeline
-    pipeline.add_steps_to_pipeline("download_from_stage", download_from_stage)
+    # Legger download-steget inn i pipeline. GET kan først kjøres når COPY INTO er startet (og venter selv på at den blir ferdig),
+    # og når valideringen er godkjent, så vi ikke laster ned en eksport laget på dårlig grunnlag (fail-fast).
+    # COPY INTO kjører fortsatt på serveren samtidig med valideringen.
+    # Tidsgrensen ligger i wait_for_copy (COPY_TIMEOUT_S), som avbryter COPY INTO i Snowflake; den prøves ikke på nytt.
+    pipeline.add_step("download_from_stage", download_from_stage,
+                      depends_on=["copy_into_stage", "validate_mart_has_rows"],
+                      retries=STEP_RETRIES, retry_on=TRANSIENT_ERRORS)
 
     # ---- Kjør pipeline ----
-    # Pipeline kjører steg i rekkefølge, og stopper hvis et steg feiler (fail-fast).
-    results = pipeline.run_pipeline()
-
-    # Lukker Snowflake-connection etter pipeline-run
-    client.close_connection()
+    # Pipeline kjører uavhengige steg parallelt, og stopper hvis et steg feiler (fail-fast).
+    try:
+        results = pipeline.run_pipeline()
+    except Exception:
+        # COPY INTO kjører videre på serveren selv om pipeline feilet, så vi avbryter den hvis den ble startet
+        if "top10" in copy_jobs:
+            try:
+                jobs.cancel_copy(copy_jobs["top10"])
+            except Exception as e:
+                logger.warning("Could not cancel COPY INTO (query id %s): %s", copy_jobs["top10"].query_id, e)
+        raise
+    finally:
+        # Lukker cursorene og Snowflake-connections etter pipeline-run, også når den feiler (connections går tilbake til poolen)
+        jobs.close()
+        validation_jobs.close()
+        client.close_connection()
+        validation_client.close_connection()
 
     # ---- Print rapport ----
     # Skriver en enkel rapport som ser bra ut i terminal og i GitHub README-screenshots.
-    print("\nPIPELINE REPORT")
-    for r in results:
-        status = "OK" if r.ok else "FAIL"
-        print(f"- {status} {r.name}: {r.message}")
+    # Hele rapporten bygges som én streng og skrives med ett write-kall (i stedet for én print per steg).
+    sys.stdout.write(
+        "\nPIPELINE REPORT\n"
+        + "".join(
+            f"- {'OK' if r.ok else 'FAIL'} {r.name}: {r.message} (started {r.started_at_iso}, {r.duration_ms:.0f} ms)\n"
+            for r in results
+        )
+    )
+    sys.stdout.flush()
 
 
 # Standard Python entrypoint
 if __name__ == "__main__":
-    main()
+    log_listener = setup_logging()
+    try:
+        main()
+    finally:
+        log_listener.stop()
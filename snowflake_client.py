@@ -1,25 +1,133 @@
+import atexit
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterator, Optional
+
 import snowflake.connector
 import pandas as pd
+from snowflake.connector.errors import (
+    GatewayTimeoutError,
+    NotSupportedError,
+    OperationalError,
+    ServiceUnavailableError,
+)
 
 from snowflake_config import SnowflakeConfig
 
 
+# Connections som er ledige for gjenbruk, per (account-kandidater, user, warehouse, database, schema, role).
+# Hvert element i køen er (connection, opprettet_tidspunkt, sist_brukt_tidspunkt).
+_POOL: dict[tuple, queue.Queue] = {}
+_POOL_LOCK = threading.Lock()
+# Pool-nøkler som har en oppvarmingstråd i gang, så to klienter ikke fyller samme pool samtidig
+_WARMING: set = set()
+
+logger = logging.getLogger(__name__)
+
+# Feil fra connectoren som er verdt å prøve på nytt (nettverk, 503/504), f.eks. som retry_on i ETLPipeline.
+# Query-timeouts er ikke med: et steg som bruker hele tidsgrensen sin skal feile, ikke kjøres på nytt.
+TRANSIENT_ERRORS = (OperationalError, ServiceUnavailableError, GatewayTimeoutError)
+
+# Ledige connections som har ligget lenger enn dette (sekunder) valideres med SELECT 1 før gjenbruk
+_VALIDATE_AFTER_S = 60.0
+
+# Hvilken account-streng som fungerte sist, så neste connect kan prøve den først
+_ACCOUNT_CACHE_FILE = Path.home() / ".cache" / "snowflake_client" / "last_good_account"
+
+
+def _pool_for(key: tuple) -> queue.Queue:
+    with _POOL_LOCK:
+        if key not in _POOL:
+            _POOL[key] = queue.Queue()
+        return _POOL[key]
+
+
+def _is_alive(conn) -> bool:
+    if conn.is_closed():
+        return False
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT 1")
+        return True
+    except Exception:
+        return False
+    finally:
+        cur.close()
+
+
+def _read_cached_account():
+    try:
+        return _ACCOUNT_CACHE_FILE.read_text(encoding="utf-8").strip() or None
+    except OSError:
+        return None
+
+
+def _write_cached_account(account: str) -> None:
+    # Skriver til en temp-fil og gjør rename, så en avbrutt skriving aldri etterlater en halv fil
+    try:
+        _ACCOUNT_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=_ACCOUNT_CACHE_FILE.parent, prefix=".last_good_account.")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(account)
+        os.replace(tmp_path, _ACCOUNT_CACHE_FILE)
+    except OSError as e:
+        logger.warning("Could not cache Snowflake account: %s", e)
+
+
+def _close_future_connection(future) -> None:
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        future.result().close()
+    except Exception:
+        pass
+
+
+@atexit.register
+def close_pool() -> None:
+    # Lukker alle ledige connections i poolen (kjøres automatisk når prosessen avslutter)
+    with _POOL_LOCK:
+        pools = list(_POOL.values())
+    for pool in pools:
+        while True:
+            try:
+                conn, _, _ = pool.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
 class SnowflakeClient:
     def __init__(self, config: SnowflakeConfig):
         self.config = config
         self.snowflake_connection = None
+        self._connected_at = None
+        self._session_info_cache: dict | None = None
 
     """
     SnowflakeClient er en enkel klient-klasse som håndterer tilkobling mot Snowflake og gjør det lett å kjøre SQL.
 
     Hva klassen gjør:
     - Leser inn SnowflakeConfig og bruker den til å koble til Snowflake.
-    - Prøver flere account-strenger (connection_accounts) helt til den finner en som fungerer.
+    - Prøver flere account-strenger (connection_accounts) parallelt og bruker den første som fungerer.
+      Accounten som fungerte sist caches på disk og prøves alene først.
     - Holder på én aktiv Snowflake-connection (snowflake_connection) som resten av koden kan bruke.
+    - Gjenbruker innloggede connections fra en connection pool, så neste kjøring slipper ny TLS/auth-handshake.
     - Gir hjelpefunksjoner for å:
-      - hente data fra Snowflake som en pandas DataFrame (fetch_dataframe_from_sql)
+      - hente data fra Snowflake som en pandas DataFrame (fetch_dataframe_from_sql),
+        eller batch for batch for store resultater (iter_dataframes_from_sql)
       - hente session-info (show_session_info) for å verifisere konto, region, user og role
-      - lukke connection ryddig (close_connection)
+        (caches per connection; kall invalidate_session_info() etter f.eks. USE ROLE)
+      - lukke connection ryddig (close_connection), som legger den tilbake i poolen
 
     Typisk bruk:
     1) client = SnowflakeClient(config)
@@ -34,59 +142,241 @@ class SnowflakeClient:
 
 
 
+    def _pool_key(self) -> tuple:
+        return (
+            tuple(self.config.connection_accounts),
+            self.config.user,
+            self.config.warehouse,
+            self.config.database,
+            self.config.schema,
+            self.config.role,
+        )
+
+
+
+    def _open_connection(self, account: str):
+        return snowflake.connector.connect(
+            user=self.config.user,
+            password=self.config.password,
+            account=account,
+            warehouse=self.config.warehouse,
+            database=self.config.database,
+            schema=self.config.schema,
+            role=self.config.role,
+        )
+
+
+
+    def _take_from_pool(self) -> bool:
+        pool = _pool_for(self._pool_key())
+
+        while True:
+            try:
+                conn, created_at, last_used = pool.get_nowait()
+            except queue.Empty:
+                return False
+
+            now = time.monotonic()
+            expired = now - created_at > self.config.pool_lifetime
+            if expired or (now - last_used > _VALIDATE_AFTER_S and not _is_alive(conn)):
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                continue
+
+            self.snowflake_connection = conn
+            self._connected_at = created_at
+            return True
+
+
+
+    def _warm_pool(self, account: str) -> None:
+        # Fyller poolen opp til pool_min ledige connections med accounten som nettopp fungerte.
+        # Hver connect er en full login (flere sekunder), så det skjer i en bakgrunnstråd
+        # i stedet for å forsinke connect_to_snowflake med pool_min logins etter hverandre.
+        key = self._pool_key()
+        target = min(self.config.pool_min, self.config.pool_max)
+        pool = _pool_for(key)
+        with _POOL_LOCK:
+            if pool.qsize() >= target or key in _WARMING:
+                return
+            _WARMING.add(key)
+
+        def warm() -> None:
+            try:
+                while pool.qsize() < target:
+                    now = time.monotonic()
+                    pool.put((self._open_connection(account), now, now))
+            except Exception as e:
+                logger.warning("Could not warm connection pool: %s", e)
+            finally:
+                with _POOL_LOCK:
+                    _WARMING.discard(key)
+
+        threading.Thread(target=warm, name="snowflake-pool-warmer", daemon=True).start()
+
+
+
+    def _connect_first_of(self, accounts: list):
+        # Kobler til alle kandidatene samtidig og beholder den første som lykkes.
+        # Connections som lykkes etter vinneren lukkes så fort de blir ferdige.
+        executor = ThreadPoolExecutor(max_workers=len(accounts))
+        futures = {executor.submit(self._open_connection, account): account for account in accounts}
+        winning_future = None
+        last_error = None
+
+        try:
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    last_error = e
+                    logger.warning("Failed to connect with account '%s': %s", futures[future], e)
+                    continue
+                winning_future = future
+                break
+        finally:
+            for future in futures:
+                if future is not winning_future:
+                    future.add_done_callback(_close_future_connection)
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if winning_future is None:
+            raise last_error
+        return futures[winning_future], winning_future.result()
+
+
+
     def connect_to_snowflake(self) -> None:
+        self.invalidate_session_info()
+
+        if self._take_from_pool():
+            logger.info("Reused pooled Snowflake connection")
+            return
+
         last_error = None
+        winner = None
+        cached = _read_cached_account()
+        accounts = list(self.config.connection_accounts)
 
-        for account in self.config.connection_accounts:
+        # Accounten som fungerte sist prøves alene først, så vi slipper å åpne N connections når den virker
+        if cached in accounts:
+            accounts.remove(cached)
             try:
-                self.snowflake_connection = snowflake.connector.connect(
-                    user=self.config.user,
-                    password=self.config.password,
-                    account=account,
-                    warehouse=self.config.warehouse,
-                    database=self.config.database,
-                    schema=self.config.schema,
-                    role=self.config.role,
-                )
-
-                print(f"Connected to Snowflake with account: {account}")
-                return
+                winner = (cached, self._open_connection(cached))
+            except Exception as e:
+                last_error = e
+                logger.warning("Failed to connect with account '%s': %s", cached, e)
 
+        if winner is None and accounts:
+            try:
+                winner = self._connect_first_of(accounts)
             except Exception as e:
                 last_error = e
-                print(f"Failed to connect with account '{account}': {e}")
 
-        raise RuntimeError("Could not connect to Snowflake") from last_error
+        if winner is None:
+            raise RuntimeError("Could not connect to Snowflake") from last_error
+
+        account, self.snowflake_connection = winner
+        self._connected_at = time.monotonic()
+
+        logger.info("Connected to Snowflake with account: %s", account)
+        if account != cached:
+            _write_cached_account(account)
+        self._warm_pool(account)
 
 
 
     def close_connection(self) -> None:
-        if self.snowflake_connection:
-            self.snowflake_connection.close()
-            self.snowflake_connection = None
+        self.invalidate_session_info()
+
+        if not self.snowflake_connection:
+            return
+
+        conn, created_at = self.snowflake_connection, self._connected_at
+        self.snowflake_connection = None
+        self._connected_at = None
+
+        pool = _pool_for(self._pool_key())
+        now = time.monotonic()
+        reusable = (
+            not conn.is_closed()
+            and now - created_at <= self.config.pool_lifetime
+            and pool.qsize() < self.config.pool_max
+        )
+        if reusable:
+            pool.put((conn, created_at, now))
+        else:
+            conn.close()
 
 
 
     def fetch_dataframe_from_sql(self, sql: str) -> pd.DataFrame:
+        # Bruker connectorens Arrow-format i stedet for pd.read_sql, så kolonnene bygges direkte
+        # fra Arrow-buffere uten å gå via Python-tupler rad for rad.
+        if not self.snowflake_connection:
+            raise RuntimeError("Not connected to Snowflake")
+
+        cur = self.snowflake_connection.cursor()
+        try:
+            cur.execute(sql)
+            try:
+                return cur.fetch_pandas_all()
+            except NotSupportedError:
+                # Resultater som ikke kommer i Arrow-format (f.eks. SHOW/DESCRIBE) hentes som vanlige rader
+                columns = [col[0] for col in cur.description]
+                return pd.DataFrame.from_records(cur.fetchall(), columns=columns)
+        finally:
+            cur.close()
+
+
+
+    def iter_dataframes_from_sql(self, sql: str) -> Iterator[pd.DataFrame]:
+        # Som fetch_dataframe_from_sql, men gir resultatet som én DataFrame per Arrow-batch (fetch_pandas_batches).
+        # For store resultater: behandle/skriv hver batch og slipp den, så hele resultatet aldri ligger i minnet samtidig.
         if not self.snowflake_connection:
             raise RuntimeError("Not connected to Snowflake")
-        return pd.read_sql(sql, self.snowflake_connection)
 
+        cur = self.snowflake_connection.cursor()
+        try:
+            cur.execute(sql)
+            try:
+                batches = cur.fetch_pandas_batches()
+            except NotSupportedError:
+                # Resultater som ikke kommer i Arrow-format (f.eks. SHOW/DESCRIBE) gis som én DataFrame
+                columns = [col[0] for col in cur.description]
+                yield pd.DataFrame.from_records(cur.fetchall(), columns=columns)
+                return
+            yield from batches
+        finally:
+            cur.close()
 
 
-    def show_session_info(self) -> dict:
+
+    def show_session_info(self, timeout: Optional[int] = None) -> dict:
+        # timeout = maks sekunder for queryen; Snowflake avbryter den hvis den tar lenger tid
         if not self.snowflake_connection:
             raise RuntimeError("Not connected to Snowflake")
 
+        if self._session_info_cache is not None:
+            return self._session_info_cache
+
         cur = self.snowflake_connection.cursor()
         try:
-            cur.execute("SELECT CURRENT_ACCOUNT(), CURRENT_REGION(), CURRENT_USER(), CURRENT_ROLE()")
+            cur.execute("SELECT CURRENT_ACCOUNT(), CURRENT_REGION(), CURRENT_USER(), CURRENT_ROLE()", timeout=timeout)
             row = cur.fetchone()
-            return {
+            self._session_info_cache = {
                 "current_account": row[0],
                 "current_region": row[1],
                 "current_user": row[2],
                 "current_role": row[3],
             }
+            return self._session_info_cache
         finally:
             cur.close()
+
+
+
+    def invalidate_session_info(self) -> None:
+        self._session_info_cache = None
@@ -1,27 +1,41 @@
 
-from dataclasses import dataclass, field
-from typing import List
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Tuple
 from dotenv import load_dotenv
 import os
 
 # Last inn .env
 load_dotenv()
 
-@dataclass
+# Account-strenger som prøves ved connect. Tuple, så alle config-objekter kan dele den samme.
+_DEFAULT_ACCOUNTS: Tuple[str, ...] = (
+    "lb52747.eu-north-1.aws",
+    "LB52747.eu-north-1.aws",
+    "lb52747",
+    "LB52747",
+)
+
+@dataclass(frozen=True, slots=True)
 class SnowflakeConfig:
     user: str = os.getenv("SNOWFLAKE_USER")
     password: str = os.getenv("SNOWFLAKE_PASSWORD")
 
-    connection_accounts: List[str] = field(default_factory=lambda: [
-        "lb52747.eu-north-1.aws",
-        "LB52747.eu-north-1.aws",
-        "lb52747",
-        "LB52747",
-    ])
+    connection_accounts: Tuple[str, ...] = _DEFAULT_ACCOUNTS
 
     warehouse: str = os.getenv("SNOWFLAKE_WAREHOUSE")
     database: str = os.getenv("SNOWFLAKE_DATABASE")
     schema: str = os.getenv("SNOWFLAKE_SCHEMA")
     role: str = os.getenv("SNOWFLAKE_ROLE")
 
+    # Connection pool: hvor mange connections som holdes varme, maks antall ledige i poolen,
+    # og hvor lenge (sekunder) en connection kan gjenbrukes før den lukkes og erstattes.
+    pool_min: int = int(os.getenv("SNOWFLAKE_POOL_MIN", "0"))
+    pool_max: int = int(os.getenv("SNOWFLAKE_POOL_MAX", "4"))
+    pool_lifetime: float = float(os.getenv("SNOWFLAKE_POOL_LIFETIME", "3600"))
+
 
+@lru_cache(maxsize=1)
+def get_config() -> SnowflakeConfig:
+    # Config-en er immutable, så hele prosessen kan dele én instans
+    return SnowflakeConfig()
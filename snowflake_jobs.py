@@ -2,13 +2,48 @@
 from __future__ import annotations
 
 import os
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, Literal, Optional
 
 from snowflake_client import SnowflakeClient
 
 
+_VALUE_CACHE_MAX_ENTRIES = 128  # Maks antall query-resultater som holdes i cachen (eldste kastes ut først)
+
+
+_B = {True: "TRUE", False: "FALSE"}  # Python bool -> Snowflake TRUE/FALSE
+
+# FILE_FORMAT-opsjonene for hvert eksportformat.
+# PARQUET: kolonnebasert og Snappy-komprimert, beholder datatyper. CSV: ukomprimert med header.
+_FILE_FORMATS = {
+    "PARQUET": "TYPE=PARQUET COMPRESSION=SNAPPY",
+    "CSV": "TYPE=CSV FIELD_DELIMITER=',' FIELD_OPTIONALLY_ENCLOSED_BY='\"' COMPRESSION=NONE",
+}
+
+# CREATE STAGE + COPY INTO som én mal, bygget én gang ved import. Sendes som to statements i én request (num_statements=2).
+# HEADER=TRUE beholdes også for Parquet, ellers får kolonnene navn som _COL_0, _COL_1 ...
+_COPY_TEMPLATE = (
+    "CREATE STAGE IF NOT EXISTS {stage_name};\n"
+    "COPY INTO {stage_path} FROM (\n{query}\n) "  # Query på egne linjer, så en avsluttende -- kommentar ikke sluker ")"
+    "FILE_FORMAT=({file_format}) OVERWRITE={overwrite} SINGLE={single}{max_file_size} HEADER=TRUE"
+).format_map
+
+
+def _split_table_name(fully_qualified_table: str) -> Optional[tuple]:  # "DB.SCHEMA.TABLE" -> ("DB", "SCHEMA", "TABLE")
+    parts = fully_qualified_table.strip().split(".")
+    if len(parts) != 3:  # Ikke fullt kvalifisert (eller punktum i navnet) -> kan ikke slå opp i INFORMATION_SCHEMA
+        return None
+    # Navn uten anførselstegn lagres med store bokstaver i katalogen, navn i "..." lagres som de er.
+    # "" inne i et quoted navn er et escapet anførselstegn, så det gjøres om til " for å gi katalognavnet.
+    return tuple(
+        part[1:-1].replace('""', '"') if len(part) >= 2 and part.startswith('"') and part.endswith('"') else part.upper()
+        for part in parts
+    )
+
+
 @dataclass
 class CopyOutResult:
     stage_path: str
@@ -16,6 +51,12 @@ class CopyOutResult:
     files_downloaded: int
 
 
+@dataclass
+class AsyncCopyJob:
+    stage_path: str
+    query_id: str
+
+
 """
 SnowflakeJobRunner er et lite "job layer" over SnowflakeClient som gjør koden mer ETL- og Snowflake-proff.
 
@@ -24,13 +65,15 @@ Hva den skal gjøre:
   blir korte og lesbare.
 - Gi enkle hjelpefunksjoner for å kjøre SQL (DDL/DML), hente én verdi fra en query, og gjøre valideringer
   (for eksempel rowcount på en tabell).
-- Støtte Snowflake-native export (extract) ved å bruke COPY INTO til en stage, og deretter GET for å
+- Støtte Snowflake-native export (extract) ved å bruke COPY INTO til en stage (Parquet eller CSV), og deretter GET for å
   laste ned resultatfiler lokalt. Dette er mer "Snowflake-ekte" enn å hente alt til pandas og skrive CSV der.
 
 Typisk bruk i en ETL-jobb:
 1) Kjør CREATE/ALTER/INSERT/MERGE med execute()
-2) Kjør valideringer med rowcount() / query_value()
-3) Eksporter curated data fra en mart med COPY INTO @stage/path/
+2) Kjør valideringer med rowcount() / query_value() (med ttl caches resultatet, invalidate() tømmer cachen),
+   eller flere sjekker mot samme tabell i én query med validate()
+3) Eksporter curated data fra en mart med COPY INTO @stage/path/ (eller copy_query_to_stage_async + wait_for_copy
+   for å gjøre annet arbeid mens COPY INTO kjører)
 4) Hent eksportfilene ned til en lokal exports/-mappe med GET
 
 Resultat:
@@ -42,116 +85,244 @@ Resultat:
 class SnowflakeJobRunner:  # Klasse som samler "job"-operasjoner mot Snowflake (SQL, export, osv.)
     def __init__(self, client: SnowflakeClient):  # Konstruktør som tar inn en SnowflakeClient
         self.snowflake_client = client  # Lagrer klienten så vi kan bruke connection inni metodene
+        self._value_cache: OrderedDict[tuple, tuple] = OrderedDict()  # (normalisert SQL, params) -> (verdi, utløpstidspunkt)
+        self._cur = None  # Én cursor som gjenbrukes av alle kall (lages først når den trengs)
 
 
 
-    def execute_sql(self, sql: str) -> None:  # Kjører en SQL-kommando som ikke trenger å returnere data
-        if not self.snowflake_client.snowflake_connection:  # Sjekker at vi har en aktiv connection
+    def _cursor(self):  # Gir cursoren som gjenbrukes, og lager en ny hvis connection er byttet ut eller cursoren er lukket
+        connection = self.snowflake_client.snowflake_connection
+        if not connection:  # Sjekker at vi har en aktiv connection
             raise RuntimeError("Not connected to Snowflake")  # Stopper tidlig hvis vi ikke er koblet til Snowflake
-        cur = self.snowflake_client.snowflake_connection.cursor()  # Lager en cursor for å kjøre SQL
-        try:
-            cur.execute(sql) # kjører sql
-        finally:
-            cur.close()  # Lukker cursoren uansett om SQL-en feiler eller ikke
+        if self._cur is None or self._cur.is_closed() or self._cur.connection is not connection:
+            self._cur = connection.cursor()
+        return self._cur
+
+
 
+    def close(self) -> None:  # Lukker cursoren (kall når du er ferdig med job-runneren)
+        if self._cur is not None:
+            self._cur.close()
+            self._cur = None
 
 
-    def query_value(self, sql: str):  # Kjører en SQL og returnerer én enkelt verdi (første kolonne i første rad)
-        if not self.snowflake_client.snowflake_connection:  # Sjekker at vi faktisk er koblet til Snowflake
-            raise RuntimeError("Not connected to Snowflake")  # Kaster en feil hvis vi ikke har connection
-        cur = self.snowflake_client.snowflake_connection.cursor()  # Lager en cursor som kan kjøre SQL mot Snowflake
 
+    def execute_sql(self, sql: str, num_statements: Optional[int] = None, timeout: Optional[int] = None) -> None:  # Kjører en SQL-kommando som ikke trenger å returnere data
+        # num_statements = antall ;-separerte statements i sql, som da sendes til Snowflake i én request
+        # timeout = maks sekunder for queryen; Snowflake avbryter den hvis den tar lenger tid (gjelder også query_value/validate)
         try:
-            cur.execute(sql)  # NB: dette skal være cur.execute(sql), Snowflake-cursor har ikke execute_sql
-            row = cur.fetchone()  # Henter første rad fra resultatet (eller None hvis ingen rader)
-            return row[0] if row else None  # Returnerer første kolonne i raden, eller None hvis ingen rad
+            self._cursor().execute(sql, num_statements=num_statements, timeout=timeout) # kjører sql
         finally:
-            cur.close()  # Lukker cursoren uansett om query feiler eller ikke
+            self.invalidate()  # DDL/DML kan ha endret data, så cachede query-resultater er ikke lenger til å stole på
 
 
 
-    def count_rows(self, fully_qualified_table: str) -> int:  # Teller hvor mange rader det er i en gitt tabell
+    def invalidate(self) -> None:  # Tømmer cachen for query_value/count_rows (kall etter steg som endrer data)
+        self._value_cache.clear()
+
+
+
+    def query_value(self, sql: str, ttl: Optional[float] = None, params: Optional[tuple] = None,
+                    timeout: Optional[int] = None):  # Kjører en SQL og returnerer én enkelt verdi (første kolonne i første rad)
+        # ttl = antall sekunder resultatet kan gjenbrukes fra cachen. None = ingen caching.
+        # params = bind-verdier for %s i SQL-en (connectorens pyformat)
+        cache_key = (" ".join(sql.split()), params)  # Normaliserer whitespace så samme query alltid gir samme nøkkel
+        if ttl is not None:
+            cached = self._value_cache.get(cache_key)
+            if cached is not None and cached[1] > time.monotonic():  # Treff som ikke har gått ut på tid
+                self._value_cache.move_to_end(cache_key)  # Markerer som nylig brukt (LRU)
+                return cached[0]
+
+        cur = self._cursor()  # Gjenbruker cursoren (sjekker også at vi er koblet til Snowflake)
+        cur.execute(sql, params, timeout=timeout)  # NB: dette skal være cur.execute(sql), Snowflake-cursor har ikke execute_sql
+        row = cur.fetchone()  # Henter første rad fra resultatet (eller None hvis ingen rader)
+        value = row[0] if row else None  # Første kolonne i raden, eller None hvis ingen rad
+
+        if ttl is not None:
+            self._value_cache[cache_key] = (value, time.monotonic() + ttl)
+            self._value_cache.move_to_end(cache_key)
+            if len(self._value_cache) > _VALUE_CACHE_MAX_ENTRIES:
+                self._value_cache.popitem(last=False)  # Kaster ut den minst nylig brukte
+        return value
+
+
+
+    def count_rows(self, fully_qualified_table: str, ttl: Optional[float] = 60, exact: bool = False) -> int:  # Teller hvor mange rader det er i en gitt tabell
+        # Leser ROW_COUNT fra INFORMATION_SCHEMA.TABLES (kun metadata, ingen warehouse-scan).
+        # exact=True, views og tabeller som ikke finnes i katalogen går via COUNT(*) i stedet.
+        name_parts = _split_table_name(fully_qualified_table)
+        if not exact and name_parts is not None:
+            database, schema, table = name_parts
+            database = database.replace('"', '""')  # Escaper anførselstegn siden databasenavnet settes inn som identifier
+            row_count = self.query_value(
+                f'SELECT ROW_COUNT FROM "{database}".INFORMATION_SCHEMA.TABLES '
+                "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+                ttl=ttl,
+                params=(schema, table),
+            )
+            if row_count is not None:
+                return int(row_count)
+
         return int(  # Konverterer resultatet til int
 
             self.query_value(  # Kjører en SQL som returnerer én verdi
-                f"SELECT COUNT(*) FROM {fully_qualified_table}"  # SQL som teller rader i tabellen
+                f"SELECT COUNT(*) FROM {fully_qualified_table}",  # SQL som teller rader i tabellen
+                ttl=ttl,  # Gjenbruker svaret i ttl sekunder, så gjentatte valideringer slipper ny scan
             )
         )
 
 
+    def validate(self, fully_qualified_table: str, checks: Dict[str, str], timeout: Optional[int] = None) -> Dict[str, Any]:  # Kjører flere valideringer mot samme tabell i én query
+        # checks = {navn: SQL-uttrykk}, f.eks. {"rowcount": "COUNT(*)", "null_ids": "COUNT_IF(id IS NULL)"}.
+        # Alle uttrykkene havner i samme SELECT, så Snowflake scanner tabellen én gang og vi betaler én round trip.
+        if not checks:
+            return {}
+
+        # Navnene brukes som quoted aliaser, så " i et navn må dobles for å gi gyldig SQL
+        aliases = {name: '"' + name.replace('"', '""') + '"' for name in checks}
+        projection = ", ".join(f"{expression} AS {aliases[name]}" for name, expression in checks.items())
+        cur = self._cursor()  # Gjenbruker cursoren (sjekker også at vi er koblet til Snowflake)
+        cur.execute(f"SELECT {projection} FROM {fully_qualified_table}", timeout=timeout)
+        row = cur.fetchone()  # Rene aggregater gir én rad, men uttrykk med f.eks. GROUP BY/QUALIFY kan gi null rader
+        if row is None:
+            return {name: None for name in checks}
+        return dict(zip(checks, row))
+
+
+
     def create_stage_if_not_exists(self, stage_name: str) -> None:  # Sørger for at en Snowflake stage finnes (lager den hvis den ikke finnes)
         self.execute_sql(f"CREATE STAGE IF NOT EXISTS {stage_name}")  # Kjører SQL som oppretter stage trygt uten å feile hvis den allerede finnes
 
 
 
-    def copy_query_results_to_stage_csv(  # Eksporterer resultatet av en SQL-query til en Snowflake stage som CSV
+    def _build_copy_sql(  # Bygger CREATE STAGE + COPY INTO-SQL-en som både copy_query_results_to_stage og copy_query_to_stage_async bruker
+            self,  # Referanse til objektet (klassen du er inni)
+            sql_query: str,  # SQL-en du vil eksportere (SELECT ...)
+            stage_name: str,  # Navn på Snowflake stage (f.eks. VLO_EXPORT_STAGE)
+            stage_prefix: str,  # "mappe/sti" inne i stage (f.eks. customer_kpis/top10)
+            overwrite: bool = True,  # True = overskriv eksisterende filer på samme path
+            single: bool = False,  # False = Snowflake skriver flere filer parallelt; True = prøv å skrive til én fil
+            max_file_size: Optional[int] = None,  # Maks størrelse (bytes) per fil i stage, None = Snowflake sin default
+            file_format: Literal["CSV", "PARQUET"] = "PARQUET",  # PARQUET (Snappy) gir færre bytes i stage og i GET enn CSV
+    ) -> tuple:  # Returnerer (stage_path, copy_sql), der copy_sql er to statements: CREATE STAGE og COPY INTO
+
+        stage_path = f"@{stage_name}/{stage_prefix}".rstrip("/") + "/"  # Bygger stage-path og sikrer at den slutter med "/"
+
+        file_format_sql = _FILE_FORMATS.get(file_format)  # Ferdig FILE_FORMAT-tekst for PARQUET eller CSV
+        if file_format_sql is None:
+            raise ValueError(f"Unsupported file_format: {file_format}")
+
+        copy_sql = _COPY_TEMPLATE({
+            "stage_name": stage_name,
+            "stage_path": stage_path,
+            "query": sql_query.strip().rstrip(";"),  # Fjerner whitespace og semikolon så query passer trygt inni FROM (...)
+            "file_format": file_format_sql,
+            "overwrite": _B[bool(overwrite)],
+            "single": _B[bool(single)],
+            "max_file_size": f" MAX_FILE_SIZE={int(max_file_size)}" if max_file_size else "",  # Tom hvis ikke satt
+        })
+
+        return stage_path, copy_sql
+
+
+
+    def copy_query_results_to_stage(  # Eksporterer resultatet av en SQL-query til en Snowflake stage (Parquet eller CSV)
             self,  # Referanse til objektet (klassen du er inni)
             sql_query: str,  # SQL-en du vil eksportere (SELECT ...)
             stage_name: str,  # Navn på Snowflake stage (f.eks. VLO_EXPORT_STAGE)
             stage_prefix: str,  # "mappe/sti" inne i stage (f.eks. customer_kpis/top10)
             overwrite: bool = True,  # True = overskriv eksisterende filer på samme path
-            single: bool = True,  # True = prøv å skrive resultatet til én fil
+            single: bool = False,  # False = Snowflake skriver flere filer parallelt; True = prøv å skrive til én fil
+            max_file_size: Optional[int] = None,  # Maks størrelse (bytes) per fil i stage, None = Snowflake sin default
+            file_format: Literal["CSV", "PARQUET"] = "PARQUET",  # PARQUET (Snappy) gir færre bytes i stage og i GET enn CSV
     ) -> str:  # Returnerer stage-pathen som ble brukt (@stage/prefix/)
 
+        stage_path, copy_sql = self._build_copy_sql(sql_query, stage_name, stage_prefix, overwrite=overwrite,
+                                                    single=single, max_file_size=max_file_size,
+                                                    file_format=file_format)
 
+        self.execute_sql(copy_sql, num_statements=2)  # Lager stage (hvis den ikke finnes) og eksporterer i samme request
+        return stage_path
 
-        self.create_stage_if_not_exists(stage_name)  # Sørger for at stage finnes før vi eksporterer
 
-        stage_path = f"@{stage_name}/{stage_prefix}".rstrip("/") + "/"  # Bygger stage-path og sikrer at den slutter med "/"
 
-        overwrite_str = "TRUE" if overwrite else "FALSE"  # Gjør Python bool om til Snowflake TRUE/FALSE
-        single_str = "TRUE" if single else "FALSE"  # Gjør Python bool om til Snowflake TRUE/FALSE
+    def copy_query_to_stage_async(  # Som copy_query_results_to_stage, men venter ikke på at COPY INTO blir ferdig
+            self,
+            sql_query: str,
+            stage_name: str,
+            stage_prefix: str,
+            overwrite: bool = True,
+            single: bool = False,
+            max_file_size: Optional[int] = None,
+            file_format: Literal["CSV", "PARQUET"] = "PARQUET",
+    ) -> AsyncCopyJob:  # Returnerer stage-path og query-id, som sendes til wait_for_copy() før GET
 
+        stage_path, copy_sql = self._build_copy_sql(sql_query, stage_name, stage_prefix, overwrite=overwrite,
+                                                    single=single, max_file_size=max_file_size,
+                                                    file_format=file_format)
 
+        cur = self._cursor()
+        cur.execute_async(copy_sql, num_statements=2)  # Sender CREATE STAGE + COPY INTO til Snowflake og returnerer med en gang
+        return AsyncCopyJob(stage_path=stage_path, query_id=cur.sfqid)
 
-        clean_query = sql_query.strip().rstrip(";")  # Fjerner whitespace og semikolon så query passer trygt inni FROM (...)
 
-        copy_sql = f"""
-        COPY INTO {stage_path}
-        FROM (
-            {clean_query}
-        )
-        FILE_FORMAT = (TYPE=CSV FIELD_DELIMITER=',' FIELD_OPTIONALLY_ENCLOSED_BY='"' COMPRESSION=NONE)
-        OVERWRITE = {overwrite_str}
-        SINGLE = {single_str}
-        HEADER = TRUE
-        """
 
-        self.execute_sql(copy_sql)
-        return stage_path
+    def cancel_copy(self, job: AsyncCopyJob) -> None:  # Avbryter en async COPY INTO i Snowflake (ufarlig hvis den allerede er ferdig)
+        self._cursor().execute("SELECT SYSTEM$CANCEL_QUERY(%s)", (job.query_id,))
 
 
 
+    def wait_for_copy(self, job: AsyncCopyJob, poll_interval: float = 0.5,
+                      timeout: Optional[float] = None) -> str:  # Venter til en async COPY INTO er ferdig
+        # timeout = maks sekunder å vente. Går tiden ut, avbrytes COPY INTO i Snowflake før TimeoutError kastes,
+        # så queryen ikke fortsetter å skrive til stage i bakgrunnen.
+        connection = self._cursor().connection  # Samme connection som startet queryen (sjekker også at vi er koblet til)
+        deadline = time.monotonic() + timeout if timeout is not None else None
 
+        # Kaster en feil med en gang hvis COPY INTO har feilet på serveren
+        while connection.is_still_running(connection.get_query_status_throw_if_error(job.query_id)):
+            if deadline is not None and time.monotonic() >= deadline:
+                self.cancel_copy(job)
+                raise TimeoutError(f"COPY INTO {job.stage_path} (query id {job.query_id}) did not finish within {timeout} s")
+            time.sleep(poll_interval)
 
+        return job.stage_path
 
-    def download_stage_to_local(self, stage_path: str, local_dir: str) -> CopyOutResult:  # Laster ned filer fra Snowflake stage til en lokal mappe
-        """
 
-        Bruker Snowflake GET for å hente filer lokalt.
-        Krever at connector har tilgang til lokal filsti.
-        """
 
+    def copy_query_results_to_stage_csv(self, sql_query: str, stage_name: str, stage_prefix: str,
+                                        overwrite: bool = True, single: bool = False,
+                                        max_file_size: Optional[int] = None) -> str:  # Samme som over, men alltid CSV
+        return self.copy_query_results_to_stage(sql_query, stage_name, stage_prefix, overwrite=overwrite,
+                                                single=single, max_file_size=max_file_size, file_format="CSV")
 
-        if not self.snowflake_client.snowflake_connection:  # Sjekker at vi er koblet til Snowflake
-            raise RuntimeError("Not connected to Snowflake")  # Stopper hvis vi ikke er koblet til Snowflake
 
 
-        Path(local_dir).mkdir(parents=True, exist_ok=True)  # Lager lokal mappe hvis den ikke finnes
 
-        get_sql = f"GET {stage_path} file://{Path(local_dir).resolve().as_posix()}/"  # Bygger GET-kommandoen (stage -> lokal filsti)
 
-        cur = self.snowflake_client.snowflake_connection.cursor()  # Lager cursor for å kjøre GET i Snowflake
 
-        try:
-            cur.execute(get_sql)  # NB: skal være cur.execute(get_sql), ikke execute_sql
-            results = cur.fetchall() or []  # Henter resultatet fra GET (ofte én rad per fil)
-            files_downloaded = len(results)  # Teller hvor mange filer som ble lastet ned
+    def download_stage_to_local(self, stage_path: str, local_dir: str, parallel: Optional[int] = None) -> CopyOutResult:  # Laster ned filer fra Snowflake stage til en lokal mappe
+        """
 
-            return CopyOutResult(stage_path=stage_path, local_dir=local_dir,
-                                 files_downloaded=files_downloaded)  # Returnerer en oppsummering
+        Bruker Snowflake GET for å hente filer lokalt.
+        Krever at connector har tilgang til lokal filsti.
+        parallel = antall filer som lastes ned samtidig (Snowflake tillater 1-99).
+        None = ingen PARALLEL-klausul, så Snowflake bruker sin egen default (10).
+        """
+
+        if parallel is not None and not 1 <= parallel <= 99:  # GET godtar bare PARALLEL mellom 1 og 99
+            raise ValueError(f"parallel must be between 1 and 99, got {parallel}")
+
+        cur = self._cursor()  # Gjenbruker cursoren (sjekker også at vi er koblet til Snowflake)
+
+        Path(local_dir).mkdir(parents=True, exist_ok=True)  # Lager lokal mappe hvis den ikke finnes
 
+        parallel_sql = f" PARALLEL={parallel}" if parallel is not None else ""  # Tom hvis ikke satt
+        get_sql = f"GET {stage_path} file://{Path(local_dir).resolve().as_posix()}/{parallel_sql}"  # Bygger GET-kommandoen (stage -> lokal filsti)
 
-        finally:  # Dette kjører ALLTID, enten try-blokka lykkes eller feiler med exception
+        cur.execute(get_sql)  # NB: skal være cur.execute(get_sql), ikke execute_sql
+        results = cur.fetchall() or []  # Henter resultatet fra GET (ofte én rad per fil)
+        files_downloaded = len(results)  # Teller hvor mange filer som ble lastet ned
 
-            cur.close()  # Lukker cursoren så du ikke lekker ressurser (god praksis)
+        return CopyOutResult(stage_path=stage_path, local_dir=local_dir,
+                             files_downloaded=files_downloaded)  # Returnerer en oppsummering